@@ -17,7 +17,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import torchvision
-import torchvision.transforms as transforms
 from torch.utils.data import random_split
 from datetime import datetime
 import time
@@ -127,72 +126,84 @@ except:
 log(f"device={device}")
 WANDB_KEY and wandb.log({"device": str(device)})
 
+# bfloat16 autocast on CUDA; parameters and optimizer state stay float32
+USE_AMP = torch.device(device).type == "cuda"
+DATA_DTYPE = torch.bfloat16 if USE_AMP else torch.float32 # binarized images are exact in bfloat16
+
+def autocast():
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=USE_AMP)
+
 ############################ MODEL ########################
 
+def compile_on_cuda(fn, **kwargs):
+    # TorchInductor emits Triton kernels, so only compile on CUDA; elsewhere run eagerly
+    return torch.compile(fn, **kwargs) if torch.device(device).type == "cuda" else fn
+
+# Numbered according to https://arxiv.org/pdf/2210.08277 table
+# Every gate is affine in (1, A, B, AB); row i holds the coefficients of gate i
+GATE_COEFFICIENTS = [
+    # 1,  A,  B, AB
+    [ 0,  0,  0,  0], # g0  = 0
+    [ 0,  0,  0,  1], # g1  = A*B
+    [ 0,  1,  0, -1], # g2  = A - AB
+    [ 0,  1,  0,  0], # g3  = A
+    [ 0,  0,  1, -1], # g4  = B - AB
+    [ 0,  0,  1,  0], # g5  = B
+    [ 0,  1,  1, -2], # g6  = A + B - 2AB
+    [ 0,  1,  1, -1], # g7  = A + B - AB
+    [ 1, -1, -1,  1], # g8  = 1 - A - B + AB
+    [ 1, -1, -1,  2], # g9  = 1 - A - B + 2AB
+    [ 1,  0, -1,  0], # g10 = 1 - B
+    [ 1,  0, -1,  1], # g11 = 1 - B + AB
+    [ 1, -1,  0,  0], # g12 = 1 - A
+    [ 1, -1,  0,  1], # g13 = 1 - A + AB
+    [ 1,  0,  0, -1], # g14 = 1 - AB
+    [ 1,  0,  0,  0], # g15 = 1
+]
+
+def _mix_gates(A, B, coefficients):
+    # sum_i w_i * g_i(A,B) collapsed to a + b*A + c*B + d*AB; coefficients: [4,W], A, B: [W,N]
+    coefficients = coefficients.unsqueeze(dim=-1) # broadcast [4,W] -> [4,W,1]
+    return coefficients[0] + coefficients[1]*A + coefficients[2]*B + coefficients[3]*(A*B) # [W,N]
+
+mix_gates = compile_on_cuda(_mix_gates, fullgraph=True)
+
 class LearnableGate16Array(nn.Module):
-    def __init__(self, number_of_gates, number_of_inputs, name):
+    def __init__(self, number_of_gates, number_of_inputs, name, w=None, c=None):
         super(LearnableGate16Array, self).__init__()
         self.number_of_gates = number_of_gates
         self.number_of_inputs = number_of_inputs
         self.name = name
-        self.w = nn.Parameter(torch.zeros((16, number_of_gates), dtype=torch.float32)) # [16, W]
-        self.zeros = torch.empty(0)
-        self.ones = torch.empty(0)
-        self.binarized = False
+        # w: optional [16, W] view into Model.W_all; otherwise the layer owns its gate weights
+        self.w = w if w is not None else nn.Parameter(torch.zeros((16, number_of_gates), dtype=torch.float32)) # [16, W]
         self.frozen = False
-        self.c = nn.Parameter(torch.zeros((number_of_inputs, number_of_gates, 2), dtype=torch.float32)) # connectome       
+        # c: optional [N_in, W, 2] view into Model.C_all; otherwise the layer owns its connections
+        self.c = c if c is not None else nn.Parameter(torch.zeros((number_of_inputs, number_of_gates, 2), dtype=torch.float32)) # connectome       
         # Only Gaussian inits supported for now
         nn.init.normal_(self.w, mean=0.0, std=1)
         nn.init.normal_(self.c, mean=0.0, std=1)
-
-
-    def forward(self, x):
-        batch_size = x.shape[0]
-        connections = F.softmax(self.c, dim=0) if not self.binarized else self.c
-        # [batch_size, number_of_inputs] x [number_of_inputs, number_of_gates*2] -> [batch_size, number_of_gates*2]
-        x = torch.matmul(x, connections.view(self.number_of_inputs, self.number_of_gates*2))
-        x = x.view(batch_size, self.number_of_gates, 2)
-
-        A = x[:,:,0]
-        A = A.transpose(0,1)
-        B = x[:,:,1]
-        B = B.transpose(0,1)
-
-        if self.zeros.shape != A.shape:
-            self.zeros = torch.zeros_like(A)
-        if self.ones.shape != A.shape:
-            self.ones = torch.ones_like(A)
-            
-        # Numbered according to https://arxiv.org/pdf/2210.08277 table
-        AB = A*B
-
-        g0  = self.zeros
-        g1  = AB
-        g2  = A - AB
-        g3  = A
-        g4  = B - AB
-        g5  = B
-        g7  = A + B - AB
-        g6  = g7    - AB            # A + B - 2 * A * B
-        g8  = self.ones - g7
-        g9  = self.ones - g6
-        g10 = self.ones - B
-        g11 = self.ones - g4
-        g12 = self.ones - A
-        g13 = self.ones - g2
-        g14 = self.ones - AB
-        g15 = self.ones
-
-        weights = F.softmax(self.w, dim=0) if not self.binarized else self.w
-        gates = torch.stack([
-            g0, g1, g2, g3, g4, g5, g6, g7,
-            g8, g9, g10, g11, g12, g13, g14, g15
-            ], dim=0)
-        assert gates.dim() > 1
-        if gates.dim() == 2:
-            gates = gates.unsqueeze(dim=1)                    # broadcast [C,N] -> [C,1,N]; C=16, N=batch_size
-        x = (gates * weights.unsqueeze(dim=-1)).sum(dim=0) # [C,W,N] .* (broadcast [C,W] -> [C,W,1]) =[sum-over-C]=> [W,N]
-        return x.transpose(0,1)
+        self.register_buffer("gate_coefficients", torch.tensor(GATE_COEFFICIENTS, dtype=torch.float32), persistent=False) # [16, 4]
+
+
+    def forward(self, x, weights=None, connections=None):
+        # Batch-size-last: x is [number_of_inputs, batch_size], output is [number_of_gates, batch_size]
+        # weights, connections: softmax(w), softmax(c) when already computed by the Model, e.g. for all layers at once
+        # Also returns softmax(w) and softmax(c) for reuse by the regularization losses
+        # Binarized networks are evaluated by BinaryModel, not here
+        batch_size = x.shape[-1]
+        if connections is None:
+            connections = F.softmax(self.c, dim=0)
+        # [number_of_gates*2, number_of_inputs] x [number_of_inputs, batch_size] -> [number_of_gates*2, batch_size]
+        x = torch.matmul(connections.view(self.number_of_inputs, self.number_of_gates*2).T, x)
+        x = x.view(self.number_of_gates, 2, batch_size)
+
+        A = x[:,0,:] # [W,N]
+        B = x[:,1,:] # [W,N]
+
+        if weights is None:
+            weights = F.softmax(self.w, dim=0)
+        coefficients = self.gate_coefficients.T @ weights # [4,16] x [16,W] -> [4,W]
+        return mix_gates(A, B, coefficients), weights, connections # [W,N], [16,W], [N_in,W,2]
     
 
 class Model(nn.Module):
@@ -207,34 +218,82 @@ class Model(nn.Module):
         
         self.outputs_per_category = self.last_layer_gates // self.number_of_categories
         assert self.last_layer_gates == self.number_of_categories * self.outputs_per_category
+        self.uniform_width = len(set(self.net_architecture)) == 1 # all layers have the same number of gates
+        self.register_buffer("pass_idx", torch.tensor([3, 5, 10, 12], dtype=torch.long), persistent=False) # passthrough gates A, B, not B, not A
+        # Same-width layers share one [L, 16, W] gate weight Parameter: one softmax, one regularization reduction and one optimizer tensor
+        if self.uniform_width:
+            self.W_all = nn.Parameter(torch.zeros((len(net_architecture), 16, self.first_layer_gates), dtype=torch.float32))
+        else:
+            self.register_parameter("W_all", None)
+        # Layers 1..L-1 of a same-width net also share inputs ([W, W, 2] each), so their connections are one [L-1, W, W, 2] Parameter;
+        # layer 0 reads the image and keeps its own
+        if self.uniform_width and len(net_architecture) > 1:
+            self.C_all = nn.Parameter(torch.zeros((len(net_architecture) - 1, self.first_layer_gates, self.first_layer_gates, 2), dtype=torch.float32))
+        else:
+            self.register_parameter("C_all", None)
 
         layers_ = []
         for layer_idx, layer_gates in enumerate(net_architecture):
+            w = self.W_all[layer_idx] if self.W_all is not None else None
             if layer_idx==0:
-                layers_.append(LearnableGate16Array(number_of_gates=layer_gates,number_of_inputs=input_size, name=layer_idx))
+                layers_.append(LearnableGate16Array(number_of_gates=layer_gates,number_of_inputs=input_size, name=layer_idx, w=w))
             else:
-                layers_.append(LearnableGate16Array(number_of_gates=layer_gates,number_of_inputs=prev_gates, name=layer_idx))
+                c = self.C_all[layer_idx - 1] if self.C_all is not None else None
+                layers_.append(LearnableGate16Array(number_of_gates=layer_gates,number_of_inputs=prev_gates, name=layer_idx, w=w, c=c))
             prev_gates = layer_gates
         self.layers = nn.ModuleList(layers_)
 
-    def forward(self, X):
+    def _apply(self, *args, **kwargs):
+        # .to()/.cuda() replace W_all's and C_all's storage, so the layers' views have to be taken again
+        super(Model, self)._apply(*args, **kwargs)
+        if self.W_all is not None:
+            for layer_idx, layer in enumerate(self.layers):
+                layer.w = self.W_all[layer_idx]
+        if self.C_all is not None:
+            for layer_idx, layer in enumerate(self.layers[1:], start=1):
+                layer.c = self.C_all[layer_idx - 1]
+        return self
+
+    def forward(self, X, return_softmaxes=False):
+        # X: [input_size, batch_size] (batch-size-last), returns logits [batch_size, number_of_categories]
+        # With return_softmaxes, also returns softmax(w) ([L,16,W] tensor when W_all is used, else a per-layer list)
+        # and softmax(c) (a per-layer list, or (layer 0 [N_in,W,2], layers 1..L-1 [L-1,W,W,2]) when C_all is used)
+        # for the regularization losses
+        gate_weights_all = F.softmax(self.W_all, dim=1) if self.W_all is not None else None # [L,16,W]
+        connections_all = F.softmax(self.C_all, dim=1) if self.C_all is not None else None # [L-1,W,W,2]
+        gate_weights, connections = [], []
         for layer_idx in range(0, len(self.layers)):
-            X = self.layers[layer_idx](X)
-
-        X = X.view(X.size(0), self.number_of_categories, self.outputs_per_category).sum(dim=-1)
-        X = F.softmax(X, dim=-1)
+            weights = gate_weights_all[layer_idx] if gate_weights_all is not None else None
+            layer_connections = connections_all[layer_idx - 1] if connections_all is not None and layer_idx > 0 else None
+            X, layer_gate_weights, layer_connections = self.layers[layer_idx](X, weights, layer_connections)
+            gate_weights.append(layer_gate_weights)
+            connections.append(layer_connections)
+
+        X = X.view(self.number_of_categories, self.outputs_per_category, X.size(-1)).sum(dim=1)
+        X = X.T # logits; F.cross_entropy applies log_softmax itself
+        if return_softmaxes:
+            if connections_all is not None:
+                connections = (connections[0], connections_all)
+            return X, gate_weights_all if gate_weights_all is not None else gate_weights, connections
         return X
 
     def get_passthrough_fraction(self):
+        if self.W_all is not None:
+            return passthrough_regularization(F.softmax(self.W_all, dim=1), self.pass_idx)
         pass_fraction_array = torch.zeros(len(self.layers), dtype=torch.float32, device=device)
-        indices = torch.tensor([3, 5, 10, 12], dtype=torch.long)
         for layer_ix, layer in enumerate(self.layers):
             weights_after_softmax = F.softmax(layer.w, dim=0)
-            pass_weight = (weights_after_softmax[indices, :]).sum()
+            pass_weight = (weights_after_softmax[self.pass_idx, :]).sum()
             total_weight = weights_after_softmax.sum()
             pass_fraction_array[layer_ix] = pass_weight / total_weight
         return pass_fraction_array
     
+    def get_connection_idx(self):
+        # Highest-weighted A and B input of every gate, per layer [W,2]; one argmax over C_all for layers 1..L-1 when it is used
+        if self.C_all is None:
+            return [torch.argmax(layer.c.detach(), dim=0) for layer in self.layers]
+        return [torch.argmax(self.layers[0].c.detach(), dim=0)] + list(torch.argmax(self.C_all.detach(), dim=1).unbind(0))
+
     def state_dict(self, *args, **kwargs):
         state_dict = super(Model, self).state_dict(*args, **kwargs)
         state_dict['net_architecture'] = self.net_architecture
@@ -244,8 +303,7 @@ class Model(nn.Module):
         if hasattr(self, 'dataset_output'):
             state_dict['dataset_output'] = self.dataset_output
         connections = [ [], [] ]
-        for layer in self.layers:
-            ones_at = torch.argmax(layer.c, dim=0)
+        for ones_at in self.get_connection_idx():
             connections[0].append(ones_at[:,0])
             connections[1].append(ones_at[:,1])
         state_dict['connections'] = connections
@@ -258,9 +316,68 @@ class Model(nn.Module):
             self.seed = state_dict.pop('seed')
         if 'connections' in state_dict:
             state_dict.pop('connections')
+        layer_w_keys = [f"layers.{layer_idx}.w" for layer_idx in range(len(self.layers))]
+        if self.W_all is not None and all(key in state_dict for key in layer_w_keys):
+            # Checkpoints saved before W_all hold one w per layer
+            state_dict['W_all'] = torch.stack([state_dict.pop(key) for key in layer_w_keys])
+        layer_c_keys = [f"layers.{layer_idx}.c" for layer_idx in range(1, len(self.layers))]
+        if self.C_all is not None and all(key in state_dict for key in layer_c_keys):
+            # Checkpoints saved before C_all hold one c per layer
+            state_dict['C_all'] = torch.stack([state_dict.pop(key) for key in layer_c_keys])
         super(Model, self).load_state_dict(state_dict, strict=strict)
     
 
+def pack_bits(X):
+    # [features, N] of 0/1 -> [features, ceil(N/32)] int32, sample n sits in bit n%32 of word n//32
+    number_of_samples = X.shape[-1]
+    X = F.pad(X.to(torch.int32), (0, -number_of_samples % 32))
+    X = X.view(X.shape[0], -1, 32) << torch.arange(32, dtype=torch.int32, device=X.device)
+    return X.sum(dim=-1, dtype=torch.int32) # bits are disjoint, so the sum is a bitwise or
+
+def unpack_bits(X, number_of_samples):
+    # [features, words] int32 -> [features, number_of_samples] int32 of 0/1
+    X = (X.unsqueeze(-1) >> torch.arange(32, dtype=torch.int32, device=X.device)) & 1
+    return X.flatten(start_dim=1)[:, :number_of_samples]
+
+def _binary_gates(a, b, masks):
+    # Any 2-input gate is the or of the minterms its truth table selects; masks: [4,W,1] of 0 / all-ones
+    not_a, not_b = ~a, ~b
+    return (not_a & not_b & masks[0]) | (not_a & b & masks[1]) | (a & not_b & masks[2]) | (a & b & masks[3])
+
+binary_gates = compile_on_cuda(_binary_gates, fullgraph=True)
+
+class BinaryModel(nn.Module):
+    # Bit-packed inference for a binarized network: 32 samples per int32 word, bitwise ops per gate
+    def __init__(self, gate_idx, connection_idx, number_of_categories, outputs_per_category):
+        # gate_idx: per layer [W] gate numbers as in GATE_COEFFICIENTS; connection_idx: per layer [W,2] input indices of A and B
+        super(BinaryModel, self).__init__()
+        self.number_of_categories = number_of_categories
+        self.outputs_per_category = outputs_per_category
+        # Per-layer indices and masks are non-persistent buffers, so .to() moves them with the module
+        self.number_of_layers = len(gate_idx)
+        for layer_idx, (layer_gate_idx, layer_connection_idx) in enumerate(zip(gate_idx, connection_idx)):
+            # Bit (3 - 2a - b) of the gate number is its output for inputs (a, b), e.g. g6 = 0b0110 is XOR
+            truth_table = (layer_gate_idx >> torch.tensor([3, 2, 1, 0], device=layer_gate_idx.device).unsqueeze(-1)) & 1 # [4,W]
+            self.register_buffer(f"c_idx_A_{layer_idx}", layer_connection_idx[:,0].contiguous(), persistent=False) # [W] long
+            self.register_buffer(f"c_idx_B_{layer_idx}", layer_connection_idx[:,1].contiguous(), persistent=False) # [W] long
+            self.register_buffer(f"gate_masks_{layer_idx}", (-truth_table).to(torch.int32).unsqueeze(-1), persistent=False) # [4,W,1] int32
+
+    def layer_outputs(self, X):
+        # X: [input_size, words] packed by pack_bits, returns packed [last_layer_gates, words]
+        for layer_idx in range(self.number_of_layers):
+            c_idx_A = getattr(self, f"c_idx_A_{layer_idx}")
+            c_idx_B = getattr(self, f"c_idx_B_{layer_idx}")
+            X = binary_gates(X[c_idx_A], X[c_idx_B], getattr(self, f"gate_masks_{layer_idx}"))
+        return X
+
+    def forward(self, X, number_of_samples):
+        # Logits of the binarized network: [number_of_samples, number_of_categories]
+        X = unpack_bits(self.layer_outputs(X), number_of_samples)
+        X = X.reshape(self.number_of_categories, self.outputs_per_category, number_of_samples).sum(dim=1)
+        X = X.T.float() # logits
+        return X
+
+
 ############################ DATA ########################
 
 
@@ -268,87 +385,80 @@ class Model(nn.Module):
 
 
 ### GENERATORS
-def binarize_image_with_histogram(image, verbose=False):
-    threshold = torch.quantile(image, BINARIZE_IMAGE_TRESHOLD)
-    return (image > threshold).float()
-
-transform = transforms.Compose([
-    transforms.Resize((IMG_WIDTH, IMG_WIDTH)),
-    transforms.ToTensor(),
-    transforms.Lambda(lambda x: x.view(-1)),
-    transforms.Lambda(lambda x: binarize_image_with_histogram(x))
-])
+def binarize_image_with_histogram(images, verbose=False):
+    # images: [N, INPUT_SIZE], each image is thresholded at its own quantile
+    threshold = torch.quantile(images, BINARIZE_IMAGE_TRESHOLD, dim=1, keepdim=True)
+    return (images > threshold).float()
+
+def load_images(dataset):
+    # Resize and binarize the whole dataset as one batch: uint8 [N,28,28] -> [N, INPUT_SIZE]
+    # Not bit-identical to the former torchvision PIL Resize pipeline: some resized pixels differ by one uint8 level,
+    # which flips a small fraction of binarized pixels, so accuracies are not directly comparable with earlier runs
+    images = dataset.data.unsqueeze(1).float() / 255.0
+    images = F.interpolate(images, size=(IMG_WIDTH, IMG_WIDTH), mode="bilinear", antialias=True, align_corners=False)
+    images = (images * 255.0).round() / 255.0 # quantize to uint8 levels like ToTensor on a resized PIL image
+    images = images.view(len(dataset), INPUT_SIZE)
+    # torch.quantile caps its input at 16M elements, so threshold in chunks of images
+    return torch.cat([binarize_image_with_histogram(chunk) for chunk in images.split(4096)])
 
 train_dataset = torchvision.datasets.MNIST(
     root="./data",
     train=True,
-    transform=transform,
     download=True
 )
 
 test_dataset = torchvision.datasets.MNIST(
     root="./data",
     train=False,
-    transform=transform,
     download=True
 )
 
 
 train_size = int(TRAIN_FRACTION * len(train_dataset))
 val_size = len(train_dataset) - train_size
-train_dataset, val_dataset = random_split(train_dataset, [train_size, val_size], generator=torch.Generator().manual_seed(DATA_SPLIT_SEED))
+train_split, val_split = random_split(range(len(train_dataset)), [train_size, val_size], generator=torch.Generator().manual_seed(DATA_SPLIT_SEED))
+train_indices = torch.tensor(train_split.indices, dtype=torch.long)
+val_indices = torch.tensor(val_split.indices, dtype=torch.long)
 
 if ONLY_USE_DATA_SUBSET:
-    train_dataset = torch.utils.data.Subset(train_dataset, range(1024))
-    val_dataset = torch.utils.data.Subset(val_dataset, range(1024))
+    train_indices = train_indices[:1024]
+    val_indices = val_indices[:1024]
 
-### MOVE TRAIN DATASET TO GPU ###
+all_train_images = load_images(train_dataset)
 
-train_dataset_samples = len(train_dataset)
-train_images = torch.empty((train_dataset_samples, INPUT_SIZE), dtype=torch.float32, device=device)
-train_labels = torch.empty((train_dataset_samples, NUMBER_OF_CATEGORIES), dtype=torch.float32, device=device)
+### MOVE TRAIN DATASET TO GPU ###
 
-train_labels_ = torch.empty((train_dataset_samples), dtype=torch.long, device=device)
-for i, (image, label) in enumerate(train_dataset):
-    train_images[i] = image
-    train_labels_[i] = label
-train_labels = torch.nn.functional.one_hot(train_labels_, num_classes=NUMBER_OF_CATEGORIES)
-train_labels = train_labels.type(torch.float32)
+train_dataset_samples = len(train_indices)
+train_images = all_train_images[train_indices].T.to(device=device, dtype=DATA_DTYPE).contiguous() # batch-size-last
+train_labels_ = train_dataset.targets[train_indices].to(device)
 
 ### MOVE VAL DATASET TO GPU ###
 
-val_dataset_samples = len(val_dataset)
-
-val_images = torch.empty((val_dataset_samples, INPUT_SIZE), dtype=torch.float32, device=device)
-val_labels = torch.empty((val_dataset_samples, NUMBER_OF_CATEGORIES), dtype=torch.float32, device=device)
-
-val_labels_ = torch.empty((val_dataset_samples), dtype=torch.long, device=device)
-for i, (image, label) in enumerate(val_dataset):
-    val_images[i] = image
-    val_labels_[i] = label
-val_labels = torch.nn.functional.one_hot(val_labels_, num_classes=NUMBER_OF_CATEGORIES)
-val_labels = val_labels.type(torch.float32)
+val_dataset_samples = len(val_indices)
+val_images = all_train_images[val_indices].T.to(device=device, dtype=DATA_DTYPE).contiguous() # batch-size-last
+val_labels_ = train_dataset.targets[val_indices].to(device)
 
 
 ### MOVE TEST DATASET TO GPU ###
 
 test_dataset_samples = len(test_dataset)
+test_images = load_images(test_dataset).T.to(device=device, dtype=DATA_DTYPE).contiguous() # batch-size-last
+test_labels_ = test_dataset.targets.to(device)
 
-test_images = torch.empty((test_dataset_samples, INPUT_SIZE), dtype=torch.float32, device=device)
-test_labels = torch.empty((test_dataset_samples, NUMBER_OF_CATEGORIES), dtype=torch.float32, device=device)
 
-test_labels_ = torch.empty((test_dataset_samples), dtype=torch.long, device=device)
-for i, (image, label) in enumerate(test_dataset):
-    test_images[i] = image
-    test_labels_[i] = label
-test_labels = torch.nn.functional.one_hot(test_labels_, num_classes=NUMBER_OF_CATEGORIES)
-test_labels = test_labels.type(torch.float32)
+### PACK DATASETS FOR BINARY INFERENCE ###
+
+train_images_packed = pack_bits(train_images)
+val_images_packed = pack_bits(val_images)
+test_images_packed = pack_bits(test_images)
 
 
 ### INSTANTIATE THE MODEL AND MOVE TO GPU ###
 random.seed(SEED)
 torch.manual_seed(SEED)
 model = Model(seed=SEED, net_architecture=NET_ARCHITECTURE, number_of_categories=NUMBER_OF_CATEGORIES, input_size=INPUT_SIZE).to(device)
+# Compiled with CUDA graphs for the fixed-shape training step; shares parameters with `model`, which validate() runs eagerly
+train_model = compile_on_cuda(model, mode="reduce-overhead", dynamic=False)
 
 ### VALIDATE ###
 
@@ -356,63 +466,60 @@ def validate(dataset="val", model=model):
     if dataset == "val":
         number_of_samples = val_dataset_samples
         sample_images = val_images
-        sample_labels = val_labels
+        sample_images_packed = val_images_packed
+        sample_labels = val_labels_
     elif dataset == "test":
         number_of_samples = test_dataset_samples
         sample_images = test_images
-        sample_labels = test_labels
+        sample_images_packed = test_images_packed
+        sample_labels = test_labels_
     elif dataset == "train":
         number_of_samples = train_dataset_samples
         sample_images = train_images
-        sample_labels = train_labels
+        sample_images_packed = train_images_packed
+        sample_labels = train_labels_
     else:
         raise IOError(f"Unknown dataset {dataset}")
-    val_loss = 0.0
-    val_steps = 0
-    correct = 0
-    for start_idx in range(0, number_of_samples, BATCH_SIZE):
-        end_idx = min(start_idx + BATCH_SIZE, number_of_samples)
-        val_indices = torch.arange(start_idx, end_idx, device=device)    
-        x_val = sample_images[val_indices]
-        y_val = sample_labels[val_indices]
-        with torch.no_grad():
-            val_output = model(x_val)
-            val_loss += F.cross_entropy(val_output, y_val, reduction="sum").item()
-            correct += (val_output.argmax(dim=1) == y_val.argmax(dim=1)).sum().item()
-        val_steps += len(x_val)
-    val_loss /= val_steps
-    val_accuracy = correct / val_steps
-    return val_loss, val_accuracy
-
-def binarize_model(model=model, bin_value=1):
-    model_binarized = Model(seed=SEED, net_architecture=NET_ARCHITECTURE, number_of_categories=NUMBER_OF_CATEGORIES, input_size=INPUT_SIZE).to(device)
-    model_binarized.load_state_dict(model.state_dict())
-
-    for layer_idx in range(0, len(model_binarized.layers)):
-        ones_at = torch.argmax(model_binarized.layers[layer_idx].w.data, dim=0)
-        model_binarized.layers[layer_idx].w.data.zero_()
-        model_binarized.layers[layer_idx].w.data.scatter_(dim=0, index=ones_at.unsqueeze(0), value=bin_value)
-
-        ones_at = torch.argmax(model_binarized.layers[layer_idx].c.data, dim=0)
-        model_binarized.layers[layer_idx].c.data.zero_()
-        model_binarized.layers[layer_idx].c.data.scatter_(dim=0, index=ones_at.unsqueeze(0), value=bin_value)
-
-        model_binarized.layers[layer_idx].binarized = True
-
-    return model_binarized
-
-def l1_maxOnly_regularization(weights_after_softmax):
-    max_values, _ = torch.max(weights_after_softmax, dim=0, keepdim=True)
-    non_max_sum = (1 - max_values).sum()
-    largest_possible_sum = torch.prod(torch.tensor(weights_after_softmax.shape[1:])) # when all elements are uniform; cutting out 0 dim since it is maxxed over
+    # Whole dataset in a single forward pass; loss and correct count synced to the host once
+    with torch.inference_mode(), autocast():
+        if isinstance(model, BinaryModel):
+            val_output = model(sample_images_packed, number_of_samples)
+        else:
+            val_output = model(sample_images).float()
+        val_loss = F.cross_entropy(val_output, sample_labels, reduction="sum")
+        correct = (val_output.argmax(dim=1) == sample_labels).sum()
+    val_loss, correct = torch.stack([val_loss, correct.float()]).tolist()
+    return val_loss / number_of_samples, correct / number_of_samples
+
+def binarize_model(model=model):
+    # Keeps only the highest-weighted gate and the highest-weighted A and B inputs of every gate
+    if model.W_all is not None:
+        gate_idx = list(torch.argmax(model.W_all.detach(), dim=1).unbind(0)) # per layer [W], one argmax over [L,16,W]
+    else:
+        gate_idx = [torch.argmax(layer.w.detach(), dim=0) for layer in model.layers] # per layer [W]
+    connection_idx = model.get_connection_idx() # per layer [W,2]
+    return BinaryModel(gate_idx, connection_idx, model.number_of_categories, model.outputs_per_category)
+
+def l1_maxOnly_regularization(weights_after_softmax, dim=0):
+    # dims before `dim` are batch dims (e.g. stacked layers), one loss is returned per batch entry
+    max_values, _ = torch.max(weights_after_softmax, dim=dim, keepdim=True)
+    non_max_sum = (1 - max_values).flatten(start_dim=dim).sum(dim=-1)
+    largest_possible_sum = math.prod(weights_after_softmax.shape[dim+1:]) # when all elements are uniform; cutting out batch dims and the maxxed over dim
     return non_max_sum / largest_possible_sum # uniform distribution gives 1 per layer
 
-def passthrough_regularization(weights_after_softmax):
-    indices = torch.tensor([3, 5, 10, 12], dtype=torch.long)
-    pass_weight = (weights_after_softmax[indices, :]).sum()
-    total_weight = weights_after_softmax.sum()
+def passthrough_regularization(weights_after_softmax, pass_idx):
+    # weights_after_softmax: [..., 16, W], one loss is returned per leading batch entry; pass_idx: Model.pass_idx
+    pass_weight = (weights_after_softmax[..., pass_idx, :]).sum(dim=(-2, -1))
+    total_weight = weights_after_softmax.sum(dim=(-2, -1))
     return pass_weight / total_weight
 
+def _gate_weight_regularization(weights_after_softmax, pass_idx):
+    # Both softmax(w) regularizers in one graph so Inductor fuses their reductions into a single pass
+    return passthrough_regularization(weights_after_softmax, pass_idx), l1_maxOnly_regularization(weights_after_softmax, dim=-2)
+
+gate_weight_regularization = compile_on_cuda(_gate_weight_regularization, fullgraph=True)
+connection_regularization = compile_on_cuda(l1_maxOnly_regularization, fullgraph=True)
+
 
 ### TRAIN ###
 
@@ -432,45 +539,68 @@ log(f"EPOCH_STEPS={EPOCH_STEPS}, will train for {EPOCHS} EPOCHS")
 optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE, weight_decay=0) #!!!
 time_start = time.time()
 
+# Reshuffle once per pass over the train set into contiguous batches, each step then takes a view
+train_batches = max(train_dataset_samples // BATCH_SIZE, 1)
+# Sums of loss, loss_ce, connection, gate weight and passthrough regularization losses since the last printout, kept on the device to avoid a host sync per step
+running_losses = torch.zeros(5, dtype=torch.float32, device=device)
 
 for i in range(TRAINING_STEPS):
-    indices = torch.randint(0, train_dataset_samples, (BATCH_SIZE,), device=device)
-    x = train_images[indices]
-    y = train_labels[indices]
+    if i % train_batches == 0:
+        if train_dataset_samples >= BATCH_SIZE:
+            perm = torch.randperm(train_dataset_samples, device=device)[:train_batches * BATCH_SIZE]
+        else:
+            # Train split smaller than one batch: draw a single batch with replacement
+            perm = torch.randint(0, train_dataset_samples, (BATCH_SIZE,), device=device)
+        shuffled_images = train_images[:, perm].view(INPUT_SIZE, train_batches, BATCH_SIZE).transpose(0, 1).contiguous() # [batches, INPUT_SIZE, BATCH_SIZE]
+        shuffled_labels = train_labels_[perm].view(train_batches, BATCH_SIZE)
+    x = shuffled_images[i % train_batches]
+    y = shuffled_labels[i % train_batches]
     optimizer.zero_grad()
-    with torch.set_grad_enabled(True):
-        model_output = model(x)
+    with torch.set_grad_enabled(True), autocast():
+        model_output, gate_weights, connections = train_model(x, return_softmaxes=True)
+        model_output = model_output.float() # cross-entropy in float32
         loss_ce = F.cross_entropy(model_output, y) * LOSS_CE_STRENGTH
 
-        connection_regularization_loss = 0
-        gate_weight_regularization_loss = 0
-        passthrough_regularization_loss = 0
-        for layer in model.layers:
-            passthrough_regularization_loss += passthrough_regularization(F.softmax(layer.w, dim=0))
-            connection_regularization_loss += l1_maxOnly_regularization(F.softmax(layer.c, dim=0))
-            gate_weight_regularization_loss += l1_maxOnly_regularization(F.softmax(layer.w, dim=0))
+        if model.W_all is not None:
+            # All layers share [16, W]: one reduction over the [L, 16, W] softmax(W_all)
+            passthrough_losses, gate_weight_losses = gate_weight_regularization(gate_weights, model.pass_idx)
+        else:
+            passthrough_losses, gate_weight_losses = map(torch.stack, zip(*[gate_weight_regularization(layer_gate_weights, model.pass_idx) for layer_gate_weights in gate_weights]))
+        if model.C_all is not None:
+            # Layer 0 on its own, layers 1..L-1 in one reduction over the [L-1, W, W, 2] softmax(C_all)
+            first_layer_connections, connections_all = connections
+            connection_losses = torch.cat([connection_regularization(first_layer_connections).unsqueeze(0), connection_regularization(connections_all, dim=1)])
+        else:
+            connection_losses = torch.stack([connection_regularization(layer_connections) for layer_connections in connections])
         
-        passthrough_regularization_loss = passthrough_regularization_loss / len(model.layers)
-        connection_regularization_loss = connection_regularization_loss / len(model.layers)
-        gate_weight_regularization_loss = gate_weight_regularization_loss / len(model.layers)
+        passthrough_regularization_loss = passthrough_losses.mean()
+        connection_regularization_loss = connection_losses.mean()
+        gate_weight_regularization_loss = gate_weight_losses.mean()
         regularization_loss = PASSTHROUGH_REGULARIZATION * passthrough_regularization_loss + CONNECTION_REGULARIZATION * connection_regularization_loss + GATE_WEIGHT_REGULARIZATION * gate_weight_regularization_loss
         regularization_loss = (1 - LOSS_CE_STRENGTH) * regularization_loss
         
         loss = loss_ce + regularization_loss
-        loss.backward()
-        optimizer.step()
+    running_losses += torch.stack([loss, loss_ce, connection_regularization_loss, gate_weight_regularization_loss, passthrough_regularization_loss]).detach()
+    loss.backward()
+    optimizer.step()
 
-        # TODO: rewrite this as regularization
+    # TODO: rewrite this as regularization
+    if model.W_all is not None:
+        model.W_all.data[:, 0::15].mul_(1 - LEARNING_RATE*DECAY_CONST_GATES) # rows 0 and 15 (const gates) of all layers as one strided view
+    else:
         for l in model.layers:
-            for const_gate_ix in [0,15]:
-                l.w.data[const_gate_ix, :] = l.w.data[const_gate_ix, :] * (1 - LEARNING_RATE*DECAY_CONST_GATES)
+            l.w.data[0::15].mul_(1 - LEARNING_RATE*DECAY_CONST_GATES) # rows 0 and 15 (const gates) as one strided view
 
 
     if (i + 1) % PRINTOUT_EVERY == 0:
-        passthrough_log = ", ".join([f"{value * 100:.1f}%" for value in model.get_passthrough_fraction().tolist()])
-        log(f"Iteration {i + 1:10} - Loss {loss:.3f} - RegLoss {(1-loss_ce/loss)*100:.0f}% - Pass {passthrough_log}")
-        WANDB_KEY and wandb.log({"training_step": i, "loss": loss, "connection_regularization_loss":connection_regularization_loss, "gate_weight_regularization_loss":gate_weight_regularization_loss, 
-            "regularization_loss_fraction":(1-loss_ce/loss)*100, "passthrough_regularization_loss":passthrough_regularization_loss})
+        # Means over the printout interval and the passthrough fractions, copied to the host in one sync
+        printout_values = torch.cat([running_losses / PRINTOUT_EVERY, model.get_passthrough_fraction().detach()]).tolist()
+        running_losses.zero_()
+        loss_mean, loss_ce_mean, connection_loss_mean, gate_weight_loss_mean, passthrough_loss_mean = printout_values[:5]
+        passthrough_log = ", ".join([f"{value * 100:.1f}%" for value in printout_values[5:]])
+        log(f"Iteration {i + 1:10} - Loss {loss_mean:.3f} - RegLoss {(1-loss_ce_mean/loss_mean)*100:.0f}% - Pass {passthrough_log}")
+        WANDB_KEY and wandb.log({"training_step": i, "loss": loss_mean, "connection_regularization_loss":connection_loss_mean, "gate_weight_regularization_loss":gate_weight_loss_mean, 
+            "regularization_loss_fraction":(1-loss_ce_mean/loss_mean)*100, "passthrough_regularization_loss":passthrough_loss_mean})
         # log(f"loss_ce={F.cross_entropy(model_output, y).detach().item()}")
         # log(f"connection_regularization_loss={connection_regularization_loss}")
         # log(f"gate_weight_regularization_loss={gate_weight_regularization_loss}")
@@ -512,12 +642,10 @@ model_binarized = binarize_model()
 bin_test_loss, bin_test_acc = validate(dataset="test", model=model_binarized)
 log(f"BIN TEST loss={bin_test_loss:.3f} acc={bin_test_acc*100:.2f}%")
 
-with torch.no_grad():
-    X = val_images
-    for layer_idx in range(0, len(model_binarized.layers)):
-        X = model_binarized.layers[layer_idx](X)
-    model.dataset_input = val_images
-    model.dataset_output = X
+with torch.inference_mode():
+    X = model_binarized.layer_outputs(val_images_packed)
+    model.dataset_input = val_images.T.float()
+    model.dataset_output = unpack_bits(X, val_dataset_samples).T.float()
 
 model_filename = (
     f"{datetime.now(ZoneInfo(TIMEZONE)).strftime('%Y%m%d-%H%M%S')}"